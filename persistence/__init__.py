@@ -1,2 +1,2 @@
-from .dependencies import DependencySpec, DependencySpecType, NestedDependencySpec
+from .dependencies import DependencySpec, DependencySpecType, NestedDependencySpec, validate_many
 from .models import ModelContainer
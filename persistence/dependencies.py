@@ -1,23 +1,42 @@
 """This module contains the DependencySpec classes"""
 from __future__ import annotations
 
+import bisect
+import heapq
 import itertools
-import json
+import logging
+import sys
+import weakref
 from abc import ABC, abstractmethod
 from collections import Counter
 from pathlib import Path
-from typing import List
+from typing import Iterable, List, Sequence, Tuple
+
+if __package__:
+    from . import json_io
+else:
+    import json_io
+
+logger = logging.getLogger(__name__)
+
+# The keys allowed in the dict representations of DependencySpec and NestedDependencySpec
+_DEPENDENCY_SPEC_KEYS = frozenset(("dependencies", "meta"))
+_NESTED_DEPENDENCY_SPEC_KEYS = frozenset(("children", "meta"))
 
 
 class DependencySpecType(ABC):
     """Abstract base class for all DependencySpec classes"""
 
+    # Specs are created in large numbers, so they use slots instead of a __dict__. __weakref__
+    # is needed for the cache of shared specs in from_dict.
+    __slots__ = ("meta", "_depset", "__weakref__")
+
     meta: dict
     defaults: List
 
     @property
     @abstractmethod
-    def dependencies(self) -> List[str]:
+    def dependencies(self) -> Sequence[str]:
         """The dependencies of this DependencySpec"""
 
     def __iter__(self):
@@ -26,25 +45,46 @@ class DependencySpecType(ABC):
     def __len__(self):
         return len(self.dependencies)
 
+    def __contains__(self, dep):
+        return dep in self._dependency_set()
+
+    def _dependency_set(self) -> set:
+        # Built on first membership test, and reset to None whenever the dependencies change.
+        # NestedDependencySpec.__iadd__ updates it in place.
+        if self._depset is not None:
+            return self._depset
+        depset = set(self.dependencies)
+        if self._caches():
+            self._depset = depset
+        return depset
+
+    def _caches(self) -> bool:
+        # Whether values derived from the dependencies may be cached on self
+        return True
+
     def __getitem__(self, attr):
 
         if isinstance(attr, str):
-            if attr in self.dependencies:
-                return DependencySpec(dependencies=[attr], meta=self.meta)
+            if attr in self:
+                return DependencySpec(dependencies=[attr], meta=self.meta, _validate=False)
             raise ValueError(f"Dependency {attr} not found in dependencies")
 
         if isinstance(attr, int):
-            return DependencySpec(dependencies=[self.dependencies[attr]], meta=self.meta)
+            return DependencySpec(
+                dependencies=[self.dependencies[attr]], meta=self.meta, _validate=False
+            )
 
+        depset = self._dependency_set()
         for dep in attr:
-            if dep not in self.dependencies:
+            if dep not in depset:
                 raise ValueError(f"Dependency {dep} not found in dependencies")
 
         return DependencySpec(dependencies=list(attr), meta=self.meta)
 
     @staticmethod
     def from_dict(dictionary: dict | list):
-        """Convert a dictionary or list to a DependencySpec
+        """Convert a dictionary or list to a DependencySpec. Equal DependencySpec leaves returned
+        by from_dict share their dependencies, but each has its own meta.
 
         Args:
             dictionary (dict | list): The object to convert
@@ -57,9 +97,9 @@ class DependencySpecType(ABC):
             [type]: [description]
         """
         if isinstance(dictionary, dict):
-            if dictionary.keys() <= {"dependencies", "meta"}:
-                return DependencySpec(**dictionary)
-            if dictionary.keys() <= {"children", "meta"}:
+            if dictionary.keys() <= _DEPENDENCY_SPEC_KEYS:
+                return _shared_dependency_spec(dictionary)
+            if dictionary.keys() <= _NESTED_DEPENDENCY_SPEC_KEYS:
                 children = [
                     DependencySpecType.from_dict(child) for child in dictionary.get("children", [])
                 ]
@@ -83,8 +123,7 @@ class DependencySpecType(ABC):
         Args:
             path (Path): The path to save to
         """
-        with open(path, "w+", encoding="utf-8") as handle:
-            handle.write(json.dumps(self.to_dict(), indent=2))
+        json_io.dump(self.to_dict(), path)
 
     @staticmethod
     def load(path: Path):
@@ -97,9 +136,7 @@ class DependencySpecType(ABC):
             DependencySpecType: The loaded dependencySpec,
             either a DependencySpec or NestedDependencySpec.
         """
-        with open(path, "r", encoding="utf-8") as handle:
-            dictionary = json.loads(handle.read())
-            return DependencySpec.from_dict(dictionary)
+        return DependencySpec.from_dict(json_io.load(path))
 
     @abstractmethod
     def __add__(self, other: str | DependencySpecType):
@@ -115,76 +152,121 @@ class DependencySpecType(ABC):
 
     @abstractmethod
     def to_dict(self):
-        """Convert self to a dict."""
+        """Convert self to a dict. The result may be cached, and should not be mutated."""
 
 
 class DependencySpec(DependencySpecType):
     """A normal, non-nested DependencySpec"""
 
-    def __init__(self, dependencies: List[str], meta: dict = None, **kwargs) -> None:
-
-        if not all(isinstance(dep, str) for dep in dependencies):
-            raise TypeError("All dependencies must be of type str")
-        # Validate inputs
-        assert len(dependencies) > 0
-        assert len(set(dependencies)) == len(dependencies), "dependencies must be unique"
-
-        # Save dependencies
-        self.__dependencies = sorted(dependencies)
+    __slots__ = ("__dependencies", "_hash", "_dict_cache")
+
+    def __init__(
+        self, dependencies: List[str], meta: dict = None, _validate: bool = True, **kwargs
+    ) -> None:
+
+        # Internal callers that already hold a sorted list of unique str dependencies pass
+        # _validate=False to skip the checks below.
+        if _validate:
+            if not all(isinstance(dep, str) for dep in dependencies):
+                raise TypeError("All dependencies must be of type str")
+            # Validate inputs
+            assert len(dependencies) > 0
+            assert len(dict.fromkeys(dependencies)) == len(
+                dependencies
+            ), "dependencies must be unique"
+            # Dependency names are repeated across many specs, so they are interned to share
+            # one str object per name. str subclasses such as numpy.str_ cannot be interned,
+            # so they are converted to str first.
+            dependencies = sorted(sys.intern(str(dep)) for dep in dependencies)
+
+        # Save dependencies. They are stored as a tuple, so that the cached hash stays valid.
+        self.__dependencies = tuple(dependencies)
+        self._hash = hash(self.__dependencies)
+        self._depset = None
+        self._dict_cache = None
 
         # Save additional kwargs in self.meta
         self.meta = meta or {}
         self.meta.update(kwargs)
 
     @property
-    def dependencies(self) -> List[str]:
+    def dependencies(self) -> Tuple[str, ...]:
         return self.__dependencies
 
-    def __add__(self, other):
-        """Add dependencies from a DependencySpec or iterable to this."""
+    def __hash__(self):
+        return self._hash
 
-        if isinstance(other, str):
-            other = [other]
-        elif isinstance(other, int):
-            other = []
-        elif not isinstance(other, DependencySpec):
-            raise TypeError(f"Cannot add {other} of type {type(other)} to DependencySpec")
-
-        return DependencySpec(
-            dependencies=sorted(
-                set.union(set(self), set(other)) if hasattr(other, "__iter__") else set(self)
-            ),
-            meta=self.meta,
-        )
+    def __reduce__(self):
+        # The cached hash depends on the hash seed of the process, so it is recomputed on
+        # unpickling instead of being pickled with the other slots
+        return (DependencySpec, (self.__dependencies, self.meta, False))
 
-    def __iadd__(self, other):
-        """Add dependencies from a DependencySpec or iterable to this inplace."""
+    def __eq__(self, other):
+        """DependencySpec objects are equal if they have the same dependencies"""
+        if self is other:
+            return True
+        if not isinstance(other, DependencySpec):
+            return NotImplemented
+        return self._hash == other._hash and self.__dependencies == other.__dependencies
+
+    def __merged_dependencies(self, other) -> List[str]:
+        # Both operands are kept sorted and unique, so they can be merged in linear time
+        if isinstance(other, DependencySpec):
+            merged = []
+            for dep in heapq.merge(self.__dependencies, other.__dependencies):
+                if not merged or merged[-1] != dep:
+                    merged.append(dep)
+            return merged
 
         if isinstance(other, str):
-            other = [other]
-        elif isinstance(other, int):
-            other = []
-        elif not isinstance(other, DependencySpec):
-            raise TypeError(f"Cannot add {other} of type {type(other)} to DependencySpec")
-
-        self.dependencies = sorted(
-            set.union(set(self), set(other)) if hasattr(other, "__iter__") else set(self)
-        )
+            merged = list(self.__dependencies)
+            index = bisect.bisect_left(merged, other)
+            if index == len(merged) or merged[index] != other:
+                merged.insert(index, sys.intern(str(other)))
+            return merged
+
+        if isinstance(other, int):
+            return list(self.__dependencies)
+
+        raise TypeError(f"Cannot add {other} of type {type(other)} to DependencySpec")
+
+    def __add__(self, other):
+        """Add dependencies from a DependencySpec or iterable to this."""
+        return DependencySpec(self.__merged_dependencies(other), meta=self.meta, _validate=False)
+
+    def __iadd__(self, other):
+        """Add dependencies from a DependencySpec or iterable to this. DependencySpec objects
+        may be shared (see from_dict), so this returns a new object rather than mutating self."""
+        return self + other
 
     def __str__(self):
-        result = "DependencySpec object with dependencies:" + str(self.dependencies)
+        result = "DependencySpec object with dependencies:" + str(list(self.dependencies))
         return result
 
     def to_dict(self):
-        return {"dependencies": self.dependencies, "meta": self.meta or {}}
+        # The dependencies never change, so the dict is cached and only rebuilt if meta has
+        # been replaced
+        if self._dict_cache is None or self._dict_cache["meta"] is not self.meta:
+            self._dict_cache = {"dependencies": list(self.dependencies), "meta": self.meta}
+        return self._dict_cache
 
 
 class NestedDependencySpec(DependencySpecType):
     """A nested DependencySpec."""
 
-    def __init__(self, children: List[DependencySpecType], meta: dict = None, **kwargs) -> None:
+    __slots__ = ("_children", "_deps_cache", "_cacheable")
+
+    def __init__(
+        self,
+        children: List[DependencySpecType],
+        meta: dict = None,
+        _validate: bool = True,
+        **kwargs,
+    ) -> None:
 
-        if any(isinstance(child, str) for child in children):
+        # Internal callers that have already checked that the children are specs with disjoint
+        # dependencies pass _validate=False to skip the checks below.
+        if _validate and any(isinstance(child, str) for child in children):
             raise TypeError(
                 "NestedDependencySpec cannot have str children, "
                 "did you mean to construct a DependencySpec?"
@@ -193,44 +275,85 @@ class NestedDependencySpec(DependencySpecType):
         self.children = children
 
         # Validate inputs
-        assert len(children) > 0
-        if len(set(self.dependencies)) != len(self.dependencies):
-            print("Some dependencies found multiple times. Violators:")
-            cnt = Counter()
-            for dep in self.dependencies:
-                cnt[dep] += 1
-            longest_dep_name = max(map(len, cnt.keys()))
-            longest_ntimes_str = max(map(len, map(str, cnt.values())))
-            for dep, n_finds in cnt.items():
-                if n_finds > 1:
-                    spacing1 = " " * (longest_dep_name - len(dep))
-                    spacing2 = " " * (longest_ntimes_str - len(str(n_finds)))
-                    print(f"{dep} {spacing1} found {n_finds} {spacing2} times.")
-            raise ValueError("some dependencies exist multiple times")
+        if _validate:
+            assert len(children) > 0
+            # The dependency set is cached for later membership tests, so on the happy path
+            # this check costs a single pass over the dependencies
+            if len(self._dependency_set()) != len(self.dependencies):
+                _raise_duplicates(self.dependencies)
 
         # Save additional kwargs in self.meta
         self.meta = meta or {}
         self.meta.update(kwargs)
 
+    @property
+    def children(self) -> Tuple[DependencySpecType, ...]:
+        """The children of this NestedDependencySpec. This is a tuple, use += or assign a new
+        sequence of children to change them."""
+        return self._children
+
+    @children.setter
+    def children(self, children: Sequence[DependencySpecType]) -> None:
+        self._children = tuple(children)
+        self._deps_cache = None
+        self._depset = None
+
+        # A nested child can change through its own += without this spec knowing, so values
+        # derived from the children are only cached when all children are DependencySpec
+        # objects, which never change
+        self._cacheable = all(isinstance(child, DependencySpec) for child in self._children)
+
+    def _caches(self) -> bool:
+        return self._cacheable
+
+    def __reduce__(self):
+        # Pickle only the children and meta, the caches are rebuilt when needed
+        return (NestedDependencySpec, (self._children, self.meta, False))
+
     @property
     def dependencies(self) -> List[str]:
-        return list(itertools.chain(*(child.dependencies for child in self.children)))
+        # Flattening the children is comparatively expensive, so the result is cached
+        # until the children change.
+        if self._deps_cache is not None:
+            return self._deps_cache
+        dependencies = list(
+            itertools.chain.from_iterable(child.dependencies for child in self.children)
+        )
+        if self._cacheable:
+            self._deps_cache = dependencies
+        return dependencies
 
     def __add__(self, other: DependencySpec):
         if not isinstance(other, DependencySpec):
             raise TypeError(
                 f"Cannot add '{other}' of type type {type(other)} to NestedDependencySpec"
             )
-        return NestedDependencySpec(children=self.children + other, meta=self.meta)
+        if not self._dependency_set().isdisjoint(other.dependencies):
+            raise ValueError("Dependencies in other overlaps with self; cannot add")
+
+        result = NestedDependencySpec(
+            children=[*self.children, other], meta=self.meta, _validate=False
+        )
+        # The flattened dependencies of the result are known, so they are not recomputed
+        if result._cacheable:
+            result._deps_cache = [*self.dependencies, *other.dependencies]
+        return result
 
     def __iadd__(self, other: DependencySpec):
         if not isinstance(other, DependencySpec):
             raise TypeError(
                 f"Cannot add '{other}' of type type {type(other)} to NestedDependencySpec"
             )
-        if not set(self.dependencies).isdisjoint(other.dependencies):
+        depset = self._dependency_set()
+        if not depset.isdisjoint(other.dependencies):
             raise ValueError("Dependencies in other overlaps with self; cannot add")
-        self.children.append(other)
+
+        # Update the cached dependencies and dependency set instead of rebuilding them
+        if self._cacheable:
+            depset.update(other.dependencies)
+            self.dependencies.extend(other.dependencies)
+        self._children = (*self._children, other)
+        return self
 
     def __str__(self):
         result = "NestedDependencySpec object with dependencies:\n  " + "\n  ".join(
@@ -239,4 +362,58 @@ class NestedDependencySpec(DependencySpecType):
         return result
 
     def to_dict(self):
-        return {"children": [child.to_dict() for child in self.children], "meta": self.meta or {}}
+        # Not cached, since the meta of a child may be replaced without this spec knowing. The
+        # dicts of the DependencySpec leaves are cached.
+        return {"children": [child.to_dict() for child in self.children], "meta": self.meta}
+
+
+def validate_many(specs: Iterable[DependencySpecType]) -> None:
+    """Validate that no dependency is found in more than one of several specs, for example
+    all the specs used by a service. All specs are checked in a single pass.
+
+    Args:
+        specs (Iterable[DependencySpecType]): The specs to validate
+
+    Raises:
+        ValueError: If some dependency is found multiple times
+    """
+    dependencies = list(itertools.chain.from_iterable(spec.dependencies for spec in specs))
+    if len(set(dependencies)) != len(dependencies):
+        _raise_duplicates(dependencies)
+
+
+def _raise_duplicates(dependencies: Sequence[str]) -> None:
+    # Report the dependencies that are found multiple times, and raise
+    violators = {dep: n for dep, n in Counter(dependencies).items() if n > 1}
+    if logger.isEnabledFor(logging.DEBUG):
+        longest_dep_name = max(map(len, violators))
+        longest_ntimes_str = max(map(len, map(str, violators.values())))
+        logger.debug("Some dependencies found multiple times. Violators:")
+        for dep, n_finds in violators.items():
+            spacing1 = " " * (longest_dep_name - len(dep))
+            spacing2 = " " * (longest_ntimes_str - len(str(n_finds)))
+            logger.debug(f"{dep} {spacing1} found {n_finds} {spacing2} times.")
+    raise ValueError(f"some dependencies exist multiple times: {sorted(violators)}")
+
+
+# Weak cache of DependencySpec leaves created by from_dict, keyed on their dependencies
+_shared_specs: weakref.WeakValueDictionary = weakref.WeakValueDictionary()
+
+
+def _shared_dependency_spec(dictionary: dict) -> DependencySpec:
+    # Model registries attach the same sub-spec to many parents, so equal leaves share one
+    # validated dependency tuple. Each leaf still gets its own meta, since meta may be mutated.
+    # Anything that cannot be keyed is constructed as-is, which also lets DependencySpec raise
+    # the appropriate error for invalid input.
+    try:
+        key = tuple(dictionary["dependencies"])
+        spec = _shared_specs.get(key)
+    except (KeyError, TypeError):
+        return DependencySpec(**dictionary)
+
+    if spec is None:
+        spec = DependencySpec(**dictionary)
+        _shared_specs[key] = spec
+        return spec
+    return DependencySpec(spec.dependencies, meta=dictionary.get("meta"), _validate=False)
+
@@ -0,0 +1,71 @@
+"""Tools for writing and reading the json files of specs and saved models"""
+import json
+import math
+from pathlib import Path
+
+# Try to import orjson, which is used instead of json for saving and loading if available.
+orjson = None
+try:
+    import orjson
+except ImportError:
+    pass
+
+
+def dump(obj, path: Path) -> None:
+    # Write obj to path as indented json. orjson is only faster, the file is the same with json.
+    if orjson and not _has_non_finite(obj):
+        # Dates are passed through, so that orjson rejects them like json does
+        option = (
+            orjson.OPT_INDENT_2
+            | orjson.OPT_SERIALIZE_NUMPY
+            | orjson.OPT_NON_STR_KEYS
+            | orjson.OPT_PASSTHROUGH_DATETIME
+        )
+        try:
+            content = orjson.dumps(obj, option=option)
+        except orjson.JSONEncodeError:
+            # For example integers above 64 bits, which json writes. Anything json cannot write
+            # either raises below.
+            pass
+        else:
+            Path(path).write_bytes(content)
+            return
+
+    # Encoded before the file is opened, so that nothing is written if obj cannot be encoded
+    content = json.dumps(obj, indent=2, ensure_ascii=False, default=_numpy_to_python)
+    Path(path).write_text(content, encoding="utf-8")
+
+
+def load(path: Path):
+    # Read json from path
+    if orjson:
+        content = Path(path).read_bytes()
+        try:
+            return orjson.loads(content)
+        except orjson.JSONDecodeError:
+            # orjson does not accept NaN or Infinity, which json writes
+            return json.loads(content)
+
+    with open(path, "r", encoding="utf-8") as handle:
+        return json.load(handle)
+
+
+def _has_non_finite(obj) -> bool:
+    # orjson writes NaN and Infinity as null, so data holding them is written with json instead
+    if isinstance(obj, float):
+        return not math.isfinite(obj)
+    if isinstance(obj, dict):
+        return any(_has_non_finite(value) for value in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return any(_has_non_finite(value) for value in obj)
+    if type(obj).__module__ == "numpy" and hasattr(obj, "tolist"):
+        return _has_non_finite(obj.tolist())
+    return False
+
+
+def _numpy_to_python(obj):
+    # Used as default= by json, to write numpy scalars and arrays like orjson does with
+    # OPT_SERIALIZE_NUMPY
+    if type(obj).__module__ == "numpy" and hasattr(obj, "tolist"):
+        return obj.tolist()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
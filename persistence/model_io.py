@@ -1,17 +1,47 @@
-"""Tools for saving and loading models with keras and joblib (sklearn)"""
+"""Tools for saving and loading models with keras, joblib (sklearn) and numpy"""
+import functools
+import importlib
+import importlib.util
+import json
+import logging
+import os
+import pickle
+import re
 from pathlib import Path
 
-KERAS_MODEL_SAVE_FORMAT = "tf"
+# Format that keras models are saved in: "keras" for the native single-file format, or "tf" for
+# the legacy SavedModel directory format. By default (None), the native format is used if the
+# installed keras supports it, which it does from version 2.12.
+KERAS_MODEL_SAVE_FORMAT = None
+
+# Keras requires the native format to be saved with this suffix, so such models are stored
+# next to, rather than at, the path they are saved to
+KERAS_FILE_SUFFIX = ".keras"
+
+logger = logging.getLogger(__name__)
+
+# Name of the file describing models saved as numpy arrays
+NDARRAY_HEADER_FILENAME = "ndarrays.json"
+
+# Classes that define any of these are saved with pickle, not as ndarrays
+_PICKLING_ATTRIBUTES = frozenset(
+    (
+        "__slots__",
+        "__getstate__",
+        "__setstate__",
+        "__reduce__",
+        "__reduce_ex__",
+        "__getnewargs__",
+        "__getnewargs_ex__",
+    )
+)
 
-# Try to import keras. Return (keras, True) or (None, False) depending on result.
-keras = None
-try:
-    import keras
-except ImportError:
-    try:
-        from tensorflow import keras
-    except ImportError:
-        pass
+# Look for keras without importing it. Importing tensorflow takes seconds and hundreds of MB,
+# so keras is only imported once a keras model is actually saved or loaded.
+HAS_KERAS = any(importlib.util.find_spec(name) is not None for name in ("keras", "tensorflow"))
+
+# Top-level modules that keras models may be defined in
+KERAS_MODULES = ("keras", "tensorflow", "tf_keras")
 
 # Try to import joblib. Return (joblib, True) or (None, False) depending on result.
 joblib = None
@@ -20,59 +50,181 @@ try:
 except ImportError:
     pass
 
-# Initialize importer/exporter lists
+# Try to import numpy. Models that only hold numpy arrays are saved as .npy files if it is
+# available.
+numpy = None
+try:
+    import numpy
+except ImportError:
+    pass
+
+# Initialize importer/exporter tables. Exporters are picked by a predicate on the model, and
+# importers by a predicate on the path to load from, so that only the matching function is run.
 importers = []
 exporters = []
 
-# Fill importer/exporter lists
-
-if keras:
-
-    def save_keras(model: keras.Model, path: Path):
-        model.save(path, save_format=KERAS_MODEL_SAVE_FORMAT)
-
-    def load_keras(path: Path) -> keras.Model:
-        return keras.models.load_model(path)
+# Fill importer/exporter tables
 
-    exporters.append(save_keras)
-    importers.append(load_keras)
+if HAS_KERAS:
 
-if joblib:
-
-    def save_pickle(model, path: Path):
-        joblib.dump(model, path)
-
-    def load_pickle(path: Path):
-        return joblib.load(path)
-
-    exporters.append(save_pickle)
-    importers.append(load_pickle)
-
-
-def save(model, path: Path) -> None:
-    # Save a model to a file
-    success = False
-    for export_func in exporters:
+    @functools.lru_cache(maxsize=None)
+    def get_keras():
+        # Import keras on first use
         try:
-            export_func(model, path)
-            success = True
-        except:
-            pass
-
-    return success
-
+            import keras
+        except ImportError:
+            from tensorflow import keras
+        return keras
+
+    @functools.lru_cache(maxsize=None)
+    def default_keras_save_format() -> str:
+        # The native format needs keras 2.12 or later
+        version = re.findall(r"\d+", getattr(get_keras(), "__version__", ""))
+        if tuple(int(part) for part in version[:2]) >= (2, 12):
+            return "keras"
+        return "tf"
+
+    def save_keras(model, path: Path, compress=0):
+        # compress only applies to joblib pickles
+        save_format = KERAS_MODEL_SAVE_FORMAT or default_keras_save_format()
+        if save_format == "keras":
+            model.save(os.fspath(path) + KERAS_FILE_SUFFIX)
+        else:
+            model.save(path, save_format=save_format)
+
+    def load_keras(path: Path, mmap: bool = False):
+        # mmap only applies to joblib pickles
+        return get_keras().models.load_model(path)
+
+    def is_keras_model(model) -> bool:
+        # Keras models are defined in keras, so keras is only imported for models that may be
+        # keras models
+        if not any(
+            cls.__module__.partition(".")[0] in KERAS_MODULES for cls in type(model).__mro__
+        ):
+            return False
+        return isinstance(model, get_keras().Model)
+
+    def is_keras_path(path: Path) -> bool:
+        # Keras models are either .keras files, or SavedModel directories with a saved_model.pb
+        return os.fspath(path).endswith(KERAS_FILE_SUFFIX) or os.path.isfile(
+            os.path.join(path, "saved_model.pb")
+        )
+
+    exporters.append((is_keras_model, save_keras))
+    importers.append((is_keras_path, load_keras))
+
+if numpy:
+
+    def save_ndarrays(model, path: Path, compress=0):
+        # Each array is written to its own .npy file, next to a json file that records the
+        # class of the model and the names of its attributes. compress does not apply.
+        os.makedirs(path, exist_ok=True)
+        attributes = vars(model)
+        for name, array in attributes.items():
+            numpy.save(os.path.join(path, f"{name}.npy"), array, allow_pickle=False)
+
+        cls = type(model)
+        header = {
+            "module": cls.__module__,
+            "qualname": cls.__qualname__,
+            "attributes": list(attributes),
+        }
+        with open(os.path.join(path, NDARRAY_HEADER_FILENAME), "w", encoding="utf-8") as handle:
+            json.dump(header, handle)
+
+    def load_ndarrays(path: Path, mmap: bool = False):
+        # With mmap, the arrays are memory-mapped read-only from their .npy files
+        with open(os.path.join(path, NDARRAY_HEADER_FILENAME), "r", encoding="utf-8") as handle:
+            header = json.load(handle)
+
+        cls = importlib.import_module(header["module"])
+        for name in header["qualname"].split("."):
+            cls = getattr(cls, name)
+
+        # The model is restored without calling __init__, like pickle does
+        model = cls.__new__(cls)
+        for name in header["attributes"]:
+            array = numpy.load(os.path.join(path, f"{name}.npy"), mmap_mode="r" if mmap else None)
+            object.__setattr__(model, name, array)
+        return model
+
+    def is_ndarray_model(model) -> bool:
+        # Models that only hold numpy arrays (e.g. coef_ and intercept_) skip pickling. The
+        # class must be importable by name to be restored, and must not customize pickling or
+        # use __slots__, since only __dict__ is saved and restored.
+        attributes = getattr(model, "__dict__", None)
+        return (
+            bool(attributes)
+            and all(type(value) is numpy.ndarray for value in attributes.values())
+            and all(value.dtype != object for value in attributes.values())
+            and "<locals>" not in type(model).__qualname__
+            and not any(
+                _PICKLING_ATTRIBUTES.intersection(vars(cls))
+                for cls in type(model).__mro__
+                if cls is not object
+            )
+        )
+
+    def is_ndarray_path(path: Path) -> bool:
+        return os.path.isfile(os.path.join(path, NDARRAY_HEADER_FILENAME))
+
+    exporters.append((is_ndarray_model, save_ndarrays))
+    importers.append((is_ndarray_path, load_ndarrays))
 
-def load(path: Path):
-    # Load a model from a file
-    for import_func in importers:
-        try:
-            result = import_func(path)
-            assert result is not None
-            return result
-        except BaseException as err:
-            pass
+if joblib:
 
-    raise err
+    def save_pickle(model, path: Path, compress=0):
+        # Compressed pickles are smaller, but cannot be loaded with mmap
+        joblib.dump(model, path, compress=compress, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def load_pickle(path: Path, mmap: bool = False):
+        # With mmap, numpy arrays in the pickle are memory-mapped read-only from the file
+        # instead of being read into memory. This does not apply to compressed pickles.
+        return joblib.load(path, mmap_mode="r" if mmap else None)
+
+    def is_any_model(model) -> bool:
+        return True
+
+    # Anything else is pickled with joblib, into a single file
+    exporters.append((is_any_model, save_pickle))
+    importers.append((os.path.isfile, load_pickle))
+
+
+def save(model, path: Path, compress=0) -> bool:
+    # Save a model to a file, with the first exporter that accepts the model. compress is passed
+    # on to joblib.dump, for example 3 or ("lz4", 3).
+    for accepts_model, export_func in exporters:
+        if accepts_model(model):
+            logger.debug(f"Saving {type(model).__name__} to {path} with {export_func.__name__}")
+            export_func(model, path, compress=compress)
+            return True
+
+    # Raise rather than return False, so that callers such as ModelContainer.save cannot
+    # silently skip the model
+    raise ValueError(f"No exporter found for model of type {type(model)}")
+
+
+def load(path: Path, mmap: bool = False):
+    # Load a model from a file, with the first importer that accepts the path. With mmap, numpy
+    # arrays in joblib pickles and numpy array models are read-only views of the files, and
+    # must not be mutated. Loaded models are cached by ModelContainer.load, not here.
+    path = _stored_path(path)
+    for accepts_path, import_func in importers:
+        if accepts_path(path):
+            logger.debug(f"Loading model from {path} with {import_func.__name__}")
+            return import_func(path, mmap=mmap)
+
+    raise ValueError(f"No importer found for model at {path}")
+
+
+def _stored_path(path: Path) -> str:
+    # The path a model saved to path is stored at
+    path = os.fspath(path)
+    keras_path = path + KERAS_FILE_SUFFIX
+    if not os.path.exists(path) and os.path.isfile(keras_path):
+        return keras_path
+    return path
 
 
 if __package__ and not importers and not exporters:
@@ -1,12 +1,17 @@
 """In this file, the ModelContainer class is defined, as well as some helper logic"""
 import datetime
-import json
 import os
-from abc import ABC, abstractmethod
+import re
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Iterable
+from typing import Iterable, Protocol, runtime_checkable
 
 if __package__:
+    from . import json_io
     from .dependencies import DependencySpecType
 
     if os.getenv("SKIP_PERSISTENCE_LOADERS"):
@@ -17,6 +22,7 @@ if __package__:
     else:
         from . import model_io
 else:
+    import json_io
     from dependencies import DependencySpecType
 
     if os.getenv("SKIP_PERSISTENCE_LOADERS"):
@@ -33,11 +39,27 @@ MODEL_FILENAME: str = "model"
 X_SPEC_FILENAME: str = "X_spec.json"
 Y_SPEC_FILENAME: str = "y_spec.json"
 EXTRAS_FILENAME: str = "extras.json"
+META_FILENAME: str = "meta.json"
 
+# Number of loaded ModelContainers kept in memory by ModelContainer.load
+LOAD_CACHE_SIZE: int = 32
 
-class BaseEstimator(ABC):
-    @abstractmethod
-    def fit(X: Iterable, y: Iterable) -> None:
+# Suffix of the folders that ModelContainer.save stages its files in, followed by the random
+# characters added by tempfile.mkdtemp
+STAGING_SUFFIX: str = ".tmp."
+_STAGING_NAME = re.compile(rf".*{re.escape(STAGING_SUFFIX)}[a-z0-9_]{{8}}")
+
+# Cache of loaded ModelContainers, from oldest to most recently used
+_load_cache: OrderedDict = OrderedDict()
+_load_cache_lock = threading.Lock()
+
+
+@runtime_checkable
+class BaseEstimator(Protocol):
+    """Interface of the models in a ModelContainer. Models only need to implement fit and
+    predict, they do not need to subclass this."""
+
+    def fit(self, X: Iterable, y: Iterable) -> None:
         """Fit model
 
         Args:
@@ -45,8 +67,7 @@ class BaseEstimator(ABC):
             y (Iterable): [description]
         """
 
-    @abstractmethod
-    def predict(X: Iterable) -> Iterable:
+    def predict(self, X: Iterable) -> Iterable:
         """Predict with model
 
         Args:
@@ -69,10 +90,12 @@ class ModelContainer:
         eval_metrics=None,
     ) -> None:
 
+        # These checks are compiled out with python -O. Two hasattr calls are cheaper than
+        # isinstance(model, BaseEstimator), which probes the protocol members the same way.
         assert hasattr(model, "predict"), "model must implement 'predict'"
         assert hasattr(model, "fit"), "model must implement 'fit'"
 
-        if eval_metrics:
+        if eval_metrics is not None:
             assert isinstance(
                 eval_metrics, dict
             ), "eval_metrics (if provided) must be a dict of {metric: value} pairs"
@@ -81,46 +104,60 @@ class ModelContainer:
         self.X_spec: DependencySpecType = X_spec
         self.y_spec: DependencySpecType = y_spec
         self.dt: datetime.timedelta = dt
-        self.eval_metrics: dict = eval_metrics or {}
+        self.eval_metrics: dict = eval_metrics if eval_metrics is not None else {}
 
     @staticmethod
     def __model_save_paths(save_root: Path):
         # All the save paths for model directories
 
-        model_path = os.path.join(save_root, MODEL_FILENAME)
-        X_spec_path = os.path.join(save_root, X_SPEC_FILENAME)
-        y_spec_path = os.path.join(save_root, Y_SPEC_FILENAME)
-        extras_path = os.path.join(save_root, EXTRAS_FILENAME)
+        root = Path(save_root)
+        model_path = root / MODEL_FILENAME
+        X_spec_path = root / X_SPEC_FILENAME
+        y_spec_path = root / Y_SPEC_FILENAME
+        extras_path = root / EXTRAS_FILENAME
+        meta_path = root / META_FILENAME
 
-        return model_path, X_spec_path, y_spec_path, extras_path
+        return model_path, X_spec_path, y_spec_path, extras_path, meta_path
 
     @staticmethod
     def __timedelta_to_dict(delta: datetime.timedelta) -> dict:
-        return {"days": delta.days, "seconds": delta.seconds, "microseconds": delta.microseconds}
+        return {"total_seconds": delta.total_seconds()}
 
     @staticmethod
     def __dict_to_timedelta(delta: dict) -> datetime.timedelta:
+        # Older saves store days, seconds and microseconds separately
+        if "total_seconds" in delta:
+            return datetime.timedelta(seconds=delta["total_seconds"])
         return datetime.timedelta(**delta)
 
     @staticmethod
     def save_spec(spec: DependencySpecType, path: Path) -> None:
         """Save a DependencySpecType to a path"""
-        with open(path, "w+", encoding="utf-8") as handle:
-            handle.write(json.dumps(spec.to_dict(), indent=2))
+        spec.save(path)
 
     @staticmethod
     def load_spec(path: Path) -> DependencySpecType:
         """Load a DependencySpecType from path"""
-        with open(path, "r", encoding="utf-8") as handle:
-            dictionary = json.loads(handle.read())
-            DependencySpecType.from_dict(dictionary)
+        return DependencySpecType.load(path)
 
-    def save(self, path: Path) -> None:
+    def save(self, path: Path, compress=0, fsync: bool = False) -> None:
         """Save model to model directory, along with everything needed to run the model.
-        This will overwrite existing files without asking
+        The files are written to a staging directory first, which then replaces the model
+        directory, so that loaders never see a partially saved model. An existing model
+        directory is replaced without asking, but a directory holding anything other than the
+        files of a saved model is never replaced.
 
         Args:
             path (Path): The path to save to (will create a folder at this location)
+            compress (optional): Compression passed on to joblib.dump, for example 3 or
+                ("lz4", 3). Compressed models are smaller, but cannot be loaded with mmap.
+                Defaults to 0 (no compression).
+            fsync (bool, optional): Flush the saved files to disk before returning, so that the
+                model survives a power loss. Defaults to False.
+
+        Raises:
+            FileExistsError: If path is a directory holding files other than those of a saved
+                model
         """
         #
         #
@@ -132,51 +169,206 @@ class ModelContainer:
             "save_timestamp": datetime.datetime.now().strftime(DATE_STR_FORMAT),
         }
 
-        # Get paths to the different files we're going to save
-        model_path, X_spec_path, y_spec_path, extras_path = self.__model_save_paths(path)
+        # Get paths to the different files we're going to save, in the staging folder. The path
+        # is resolved first, since paths like "." have no name to derive the staging folder from.
+        path = Path(path).resolve()
+
+        # The whole directory is replaced, so refuse to save over anything but a saved model
+        if path.is_dir():
+            unknown = {child.name for child in path.iterdir()} - _model_entry_names()
+            if unknown:
+                raise FileExistsError(
+                    f"cannot save to {path}, it holds files that are not part of a saved "
+                    f"model: {sorted(unknown)}"
+                )
+
+        # Each save gets its own folder next to path, so that concurrent saves and folders left
+        # by crashed saves do not collide. The files are staged in a subfolder of it, since
+        # mkdtemp creates folders that only the owner can read. The previous save, if any, is
+        # moved there too.
+        path.parent.mkdir(parents=True, exist_ok=True)
+        scratch = Path(tempfile.mkdtemp(prefix=f"{path.name}{STAGING_SUFFIX}", dir=path.parent))
+        staging = scratch / "staging"
+        previous = scratch / "previous"
+        model_path, _, _, _, meta_path = self.__model_save_paths(staging)
+        staging.mkdir()
 
-        # Ensure parent folder exists
-        if not os.path.isdir(path):
-            os.makedirs(path)
+        try:
+            # Save model, and specs and extras together in one meta file. The files are
+            # independent, so the small meta file is written while the (usually much larger)
+            # model is being saved.
+            meta = {
+                "X_spec": self.X_spec.to_dict(),
+                "y_spec": self.y_spec.to_dict(),
+                "extras": extras,
+            }
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                futures = [
+                    executor.submit(model_io.save, self.model, model_path, compress=compress),
+                    executor.submit(json_io.dump, meta, meta_path),
+                ]
+
+            # Raise any exception from the writes
+            for future in futures:
+                future.result()
+
+            # Flush everything once all files are written, so the writes themselves are not
+            # interleaved with disk barriers
+            if fsync:
+                self.__fsync_tree(staging)
+
+            # Publish the staging folder. A directory cannot be renamed over a non-empty one, so
+            # any previous save is moved aside first, and removed afterwards.
+            if path.is_dir():
+                path.replace(previous)
+                try:
+                    staging.replace(path)
+                except BaseException:
+                    # Put the previous save back, so that a failed save leaves it in place
+                    previous.replace(path)
+                    raise
+            else:
+                staging.replace(path)
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+        # Make the rename itself durable
+        if fsync:
+            self.__fsync_folder(path.parent)
 
-        # Save model and specs
-        model_io.save(self.model, model_path)
-        self.save_spec(self.X_spec, X_spec_path)
-        self.save_spec(self.y_spec, y_spec_path)
+    @staticmethod
+    def __fsync_tree(root: Path) -> None:
+        # Flush all files under root to disk, and then the folders themselves. The files are
+        # opened for writing, since Windows can only flush writable handles.
+        for folder, _, filenames in os.walk(root):
+            for filename in filenames:
+                fd = os.open(os.path.join(folder, filename), os.O_RDWR)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            ModelContainer.__fsync_folder(folder)
 
-        # Write extras
-        with open(extras_path, "w", encoding="utf-8") as handle:
-            handle.write(json.dumps(extras, indent=2))
+    @staticmethod
+    def __fsync_folder(folder: Path) -> None:
+        # Folders can only be opened and flushed like this on posix systems
+        if os.name != "posix":
+            return
+        fd = os.open(folder, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
 
     @staticmethod
-    def load(path: Path):
-        """Load saved model from path to folder
+    def load(path: Path, mmap: bool = False):
+        """Load saved model from path to folder. Repeated loads of an unchanged folder return
+        the same, cached, ModelContainer. The cache is cleared with
+        ModelContainer.load.cache_clear().
 
         Args:
             path (Path): Path to load from
+            mmap (bool, optional): Memory-map numpy arrays in joblib-saved models instead of
+                reading them into memory. The arrays are then read-only, and must not be
+                mutated. Defaults to False.
 
         Returns:
             ModelContainer: Loaded ModelContainer
         """
 
-        # Get internal paths (i.e. inside the original folder/path)
-        model_path, X_spec_path, y_spec_path, extras_path = ModelContainer.__model_save_paths(path)
+        path = Path(path)
+        assert not _STAGING_NAME.fullmatch(
+            path.absolute().parent.name
+        ), f"cannot load from a staging folder of an unfinished save: {path}"
+
+        # save replaces the whole folder, so the inode and mtime of the folder change whenever
+        # a new model is saved to it. The mtime and size of the files in it are also part of
+        # the key, so that files rewritten in place are detected.
+        stat = path.stat()
+        with os.scandir(path) as entries:
+            files = sorted(
+                (entry.name, entry.stat().st_mtime_ns, entry.stat().st_size) for entry in entries
+            )
+        key = (str(path.resolve()), stat.st_ino, stat.st_mtime_ns, tuple(files), mmap)
+
+        with _load_cache_lock:
+            if key in _load_cache:
+                _load_cache.move_to_end(key)
+                return _load_cache[key]
 
-        # assert all the paths exist
-        assert os.path.isfile(model_path), f"model save file does not exist: {model_path}"
-        assert os.path.isfile(X_spec_path), f"X_Spec save file does not exist: {X_spec_path}"
-        assert os.path.isfile(y_spec_path), f"y_Spec save file does not exist: {y_spec_path}"
-        assert os.path.isfile(extras_path), f"extras save file does not exist: {extras_path}"
+        container = ModelContainer.__load_uncached(path, mmap)
 
-        model = model_io.load(model_path)
-        X_spec = ModelContainer.load_spec(X_spec_path)
-        y_spec = ModelContainer.load_spec(y_spec_path)
+        with _load_cache_lock:
+            _load_cache[key] = container
+            if len(_load_cache) > LOAD_CACHE_SIZE:
+                _load_cache.popitem(last=False)
 
-        # Eval metrics and dt are stored in the little extras file
-        with open(extras_path, "r", encoding="utf-8") as handle:
-            extras = json.loads(handle.read())
+        return container
+
+    @staticmethod
+    def __load_uncached(path: Path, mmap: bool):
+        # Load saved model from path to folder, without going through the cache
+
+        # Get internal paths (i.e. inside the original folder/path)
+        (
+            model_path,
+            X_spec_path,
+            y_spec_path,
+            extras_path,
+            meta_path,
+        ) = ModelContainer.__model_save_paths(path)
+
+        # assert all the paths exist, listing the directory once instead of a stat per file
+        names = {child.name for child in path.iterdir()}
+        assert (
+            MODEL_FILENAME in names or MODEL_FILENAME + model_io.KERAS_FILE_SUFFIX in names
+        ), f"model save file does not exist: {model_path}"
+
+        # Read the files concurrently, like they are written in save
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            model = executor.submit(model_io.load, model_path, mmap=mmap)
+
+            if META_FILENAME in names:
+                # Specs, eval metrics and dt are stored together in the meta file
+                meta = json_io.load(meta_path)
+                X_spec = DependencySpecType.from_dict(meta["X_spec"])
+                y_spec = DependencySpecType.from_dict(meta["y_spec"])
+                extras = meta["extras"]
+            else:
+                # Older saves store them in separate files
+                assert X_SPEC_FILENAME in names, f"X_Spec save file does not exist: {X_spec_path}"
+                assert Y_SPEC_FILENAME in names, f"y_Spec save file does not exist: {y_spec_path}"
+                assert EXTRAS_FILENAME in names, f"extras save file does not exist: {extras_path}"
+
+                X_spec = executor.submit(ModelContainer.load_spec, X_spec_path)
+                y_spec = executor.submit(ModelContainer.load_spec, y_spec_path)
+                extras = executor.submit(json_io.load, extras_path)
+                X_spec, y_spec, extras = X_spec.result(), y_spec.result(), extras.result()
+
+        model = model.result()
 
         eval_metrics = extras["eval_metrics"]
         dt = ModelContainer.__dict_to_timedelta(extras["dt"])
 
         return ModelContainer(model, X_spec, y_spec, dt, eval_metrics)
+
+
+def _model_entry_names() -> set:
+    # Names of the files and folders that make up a saved model
+    return {
+        MODEL_FILENAME,
+        MODEL_FILENAME + model_io.KERAS_FILE_SUFFIX,
+        X_SPEC_FILENAME,
+        Y_SPEC_FILENAME,
+        EXTRAS_FILENAME,
+        META_FILENAME,
+    }
+
+
+def _clear_load_cache() -> None:
+    with _load_cache_lock:
+        _load_cache.clear()
+
+
+ModelContainer.load.cache_clear = _clear_load_cache
+
@@ -4,8 +4,7 @@ import setuptools
 
 SRC_ROOT = Path(__file__).parent
 
-with open(SRC_ROOT / "README.md", "r") as f:
-    long_description = f.read()
+long_description = (SRC_ROOT / "README.md").read_text(encoding="utf-8")
 
 setuptools.setup(
     name="model_persistence",
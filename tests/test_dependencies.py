@@ -0,0 +1,60 @@
+"""Tests for the cached values of NestedDependencySpec"""
+import importlib
+
+import pytest
+
+
+@pytest.fixture(name="persistence")
+def fixture_persistence(monkeypatch):
+    # Specs do not need any model loaders
+    monkeypatch.setenv("SKIP_PERSISTENCE_LOADERS", "1")
+    return importlib.import_module("persistence")
+
+
+def test_iadd_updates_cached_dependencies(persistence):
+    spec = persistence.NestedDependencySpec([persistence.DependencySpec(["a"])])
+    assert spec.dependencies == ["a"] and "a" in spec
+
+    spec += persistence.DependencySpec(["b"])
+
+    assert spec.dependencies == ["a", "b"]
+    assert "b" in spec
+    assert spec.to_dict()["children"][-1]["dependencies"] == ["b"]
+    with pytest.raises(ValueError):
+        spec += persistence.DependencySpec(["b"])
+
+
+def test_parent_sees_iadd_on_nested_child(persistence, tmp_path):
+    inner = persistence.NestedDependencySpec([persistence.DependencySpec(["x"])])
+    outer = persistence.NestedDependencySpec([inner, persistence.DependencySpec(["y"])])
+    # Fill any caches before the child changes
+    assert outer.dependencies == ["x", "y"] and "x" in outer
+    outer.to_dict()
+
+    inner += persistence.DependencySpec(["w"])
+
+    assert outer.dependencies == ["x", "w", "y"]
+    assert "w" in outer
+    path = tmp_path / "spec.json"
+    outer.save(path)
+    assert "w" in persistence.DependencySpecType.load(path)
+
+
+def test_parent_sees_replaced_child_meta(persistence):
+    child = persistence.DependencySpec(["a"])
+    spec = persistence.NestedDependencySpec([child])
+    spec.to_dict()
+
+    child.meta = {"x": 1}
+
+    assert spec.to_dict()["children"][0]["meta"] == {"x": 1}
+
+
+def test_children_cannot_be_mutated_in_place(persistence):
+    spec = persistence.NestedDependencySpec([persistence.DependencySpec(["a"])])
+
+    assert isinstance(spec.children, tuple)
+    spec.children = [*spec.children, persistence.DependencySpec(["b"])]
+
+    assert spec.dependencies == ["a", "b"]
+    assert "b" in spec
@@ -0,0 +1,87 @@
+"""Tests for saving and loading models that only hold numpy arrays"""
+import pytest
+
+numpy = pytest.importorskip("numpy")
+
+from persistence import model_io
+
+
+class LinearModel:
+    def __init__(self):
+        self.coef_ = numpy.arange(6, dtype=float).reshape(2, 3)
+        self.intercept_ = numpy.array([0.5, -0.5])
+
+    def fit(self, X, y):
+        pass
+
+    def predict(self, X):
+        return X @ self.coef_.T + self.intercept_
+
+
+class StatefulModel(LinearModel):
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.restored = True
+
+
+class SlottedModel(LinearModel):
+    __slots__ = ("extra",)
+
+
+class ObjectArrayModel(LinearModel):
+    def __init__(self):
+        super().__init__()
+        self.labels_ = numpy.array(["a", None], dtype=object)
+
+
+def test_ndarray_model_round_trip(tmp_path):
+    model = LinearModel()
+    path = tmp_path / "model"
+
+    model_io.save(model, path)
+    loaded = model_io.load(path)
+
+    assert (path / model_io.NDARRAY_HEADER_FILENAME).is_file()
+    assert type(loaded) is LinearModel
+    assert vars(loaded).keys() == vars(model).keys()
+    numpy.testing.assert_array_equal(loaded.coef_, model.coef_)
+    numpy.testing.assert_array_equal(loaded.intercept_, model.intercept_)
+
+
+def test_ndarray_model_mmap(tmp_path):
+    path = tmp_path / "model"
+    model_io.save(LinearModel(), path)
+
+    loaded = model_io.load(path, mmap=True)
+
+    assert isinstance(loaded.coef_, numpy.memmap)
+    assert not loaded.coef_.flags.writeable
+
+
+@pytest.mark.parametrize("model_class", [StatefulModel, SlottedModel, ObjectArrayModel])
+def test_models_with_custom_state_are_pickled(model_class, tmp_path):
+    pytest.importorskip("joblib")
+    model = model_class()
+    if model_class is SlottedModel:
+        model.extra = "kept"
+    path = tmp_path / "model"
+
+    assert not model_io.is_ndarray_model(model)
+    model_io.save(model, path)
+    loaded = model_io.load(path)
+
+    assert path.is_file()
+    assert type(loaded) is model_class
+    numpy.testing.assert_array_equal(loaded.coef_, model.coef_)
+    if model_class is StatefulModel:
+        assert loaded.restored
+    if model_class is SlottedModel:
+        assert loaded.extra == "kept"
+
+
+def test_local_classes_are_not_ndarray_models():
+    class LocalModel(LinearModel):
+        pass
+
+    assert model_io.is_ndarray_model(LinearModel())
+    assert not model_io.is_ndarray_model(LocalModel())
@@ -0,0 +1,113 @@
+"""Tests for saving and loading specs and models with ModelContainer"""
+import importlib
+
+import pytest
+
+
+@pytest.fixture(name="persistence")
+def fixture_persistence(monkeypatch):
+    # The spec round-trip does not need any model loaders
+    monkeypatch.setenv("SKIP_PERSISTENCE_LOADERS", "1")
+    return importlib.import_module("persistence")
+
+
+def test_save_load_spec_round_trip(persistence, tmp_path):
+    spec = persistence.NestedDependencySpec(
+        [persistence.DependencySpec(["b", "a"], source="raw"), persistence.DependencySpec(["c"])],
+        version=2,
+    )
+    path = tmp_path / "spec.json"
+
+    persistence.ModelContainer.save_spec(spec, path)
+    loaded = persistence.ModelContainer.load_spec(path)
+
+    assert loaded is not None
+    assert loaded.to_dict() == spec.to_dict()
+    assert loaded.dependencies == spec.dependencies
+
+
+def test_save_load_leaf_spec_round_trip(persistence, tmp_path):
+    spec = persistence.DependencySpec(["x", "y"], unit="m")
+    path = tmp_path / "spec.json"
+
+    persistence.ModelContainer.save_spec(spec, path)
+    loaded = persistence.ModelContainer.load_spec(path)
+
+    assert loaded == spec
+    assert loaded.meta == spec.meta
+
+
+class ConstantModel:
+    def __init__(self, value):
+        self.value = value
+
+    def fit(self, X, y):
+        pass
+
+    def predict(self, X):
+        return [self.value for _ in X]
+
+
+@pytest.fixture(name="make_container")
+def fixture_make_container(persistence):
+    # Plain models are pickled with joblib
+    pytest.importorskip("joblib")
+
+    def make_container(value):
+        return persistence.ModelContainer(
+            ConstantModel(value),
+            persistence.DependencySpec(["x"]),
+            persistence.DependencySpec(["y"]),
+        )
+
+    return make_container
+
+
+def test_save_replaces_previous_save(persistence, make_container, tmp_path):
+    path = tmp_path / "model"
+
+    make_container(1).save(path)
+    make_container(2).save(path)
+
+    assert persistence.ModelContainer.load(path).model.value == 2
+    assert [child.name for child in tmp_path.iterdir()] == ["model"]
+
+
+def test_failed_publish_restores_previous_save(
+    persistence, make_container, tmp_path, monkeypatch
+):
+    path = tmp_path / "model"
+    make_container(1).save(path)
+    replace = type(path).replace
+
+    def failing_replace(self, target):
+        # Fail when the staged save is moved into place
+        if self.name == "staging":
+            raise OSError("publish failed")
+        return replace(self, target)
+
+    with monkeypatch.context() as patch:
+        patch.setattr(type(path), "replace", failing_replace)
+        with pytest.raises(OSError, match="publish failed"):
+            make_container(2).save(path)
+
+    persistence.ModelContainer.load.cache_clear()
+    assert persistence.ModelContainer.load(path).model.value == 1
+    assert [child.name for child in tmp_path.iterdir()] == ["model"]
+
+
+def test_save_refuses_folders_with_other_files(make_container, tmp_path):
+    (tmp_path / "notes.txt").write_text("keep me", encoding="utf-8")
+
+    with pytest.raises(FileExistsError, match="notes.txt"):
+        make_container(1).save(tmp_path)
+
+    assert [child.name for child in tmp_path.iterdir()] == ["notes.txt"]
+
+
+def test_load_folder_named_like_staging_folder(persistence, make_container, tmp_path):
+    path = tmp_path / "run.tmp.1"
+
+    make_container(1).save(path)
+
+    assert persistence.ModelContainer.load(path).model.value == 1